@@ -14,8 +14,17 @@
 # import necessary packages
 import pygame, sys, random
 from pygame import *
-from os import path
+from os import path, makedirs
+from datetime import datetime
 import math
+import struct
+import numpy as np
+import threading
+import queue
+import argparse
+import atexit
+import socket
+from time import perf_counter
 
 img_dir = path.join(path.dirname(__file__), 'images')
 sound_dir = path.join(path.dirname(__file__), 'sounds')
@@ -35,28 +44,107 @@ RED = (255,0,0)
 GREEN = (0,255,0)
 REDORANGE = (245,103,32)
 
+POWERUP_TYPES = ('shield', 'missile')
+EXPLOSION_TYPES = ('large', 'small', 'ship')
+MAX_UPGRADE = 4 # the last upgrade fires homing missiles
+TARGET_CELL_SIZE = 80 # size of the cells in the homing missile target grid
+
+# asteroid images and the smaller asteroids they split into when destroyed,
+# every fragment must be smaller than its parent in both directions
+ASTEROID_FRAGMENTS = {
+    'asteroid_big1.png': ['asteroid_medium1.png', 'asteroid_medium1.png'],
+    'asteroid_medium1.png': ['asteroid_tiny.png', 'asteroid_tiny.png'],
+    'asteroid_medium2.png': ['asteroid_tiny.png', 'asteroid_tiny.png'],
+    'asteroid_medium3.png': ['asteroid_tiny.png', 'asteroid_tiny.png'],
+    'asteroid_tiny.png': []
+}
+
+# entity and particle budgets
+MAX_ASTEROIDS = 20 # asteroids stop splitting once there are this many
+MAX_PARTICLES = 2000
+DEBRIS_PER_ASTEROID = 40
+PARTICLE_COLORS = [DARKGREY, GREY, REDORANGE, YELLOW] # from oldest to youngest
+
+# world snapshots for rewind and save states
+HISTORY_SIZE = FPS * 10 # keep the last 10 seconds of play
+SAVE_FILE = path.join(path.dirname(__file__), 'savegame.dat')
+
+# gameplay recording
+CAPTURE_DIR = path.join(path.dirname(__file__), 'captures')
+CAPTURE_BUFFERS = FPS * 2 # frames that can wait for the encoder before dropping
+# 'raw' writes RGBX video and keeps up with FPS. 'png' writes an image sequence
+# but takes around 90 ms per frame, so above about 10 fps most frames are dropped
+CAPTURE_ENCODING = 'raw'
+
+# networked co-op
+NET_PORT = 5555
+NET_SNAPSHOT_RATE = 15 # snapshots the host sends per second
+NET_INTERP_DELAY = 100 # ms that clients render behind the newest snapshot
+NET_HISTORY = 64 # snapshots kept on both sides as delta baselines
+NET_TIMEOUT = 1000 # ms without input before the host drops a client
+NET_KEYS = (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_SPACE)
+
+# window and co-op options, the game itself always runs at WINDOWWIDTH x WINDOWHEIGHT
+parser = argparse.ArgumentParser(description='The Lonely Shooter', allow_abbrev=False)
+parser.add_argument('--scale', type=int, default=1, help='window size as a multiple of the game size')
+parser.add_argument('--fullscreen', action='store_true', help='fill the screen')
+parser.add_argument('--smooth', action='store_true', help='smooth scaling instead of nearest neighbour')
+parser.add_argument('--host', action='store_true', help='host a two player co-op game')
+parser.add_argument('--join', metavar='ADDRESS', help='join a co-op game hosted at ADDRESS')
+parser.add_argument('--port', type=int, default=NET_PORT, help='co-op port')
+parser.add_argument('--bench-blit', action='store_true', help='time drawing the sprites with and without prepared images')
+options = parser.parse_args()
+if options.scale < 1:
+    parser.error('--scale must be at least 1')
+SMOOTH_SCALING = options.smooth
+
 # initialize pygame and create window
 pygame.init()
 pygame.mixer.init() # initialize for sound
-DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
+if options.fullscreen:
+    WINDOW = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+else:
+    WINDOW = pygame.display.set_mode((WINDOWWIDTH * options.scale, WINDOWHEIGHT * options.scale))
 pygame.display.set_caption('The Lonely Shooter')
 
+# everything is drawn to a fixed size framebuffer that is scaled to the window
+# once per frame, or drawn to the window directly when no scaling is needed
+if WINDOW.get_size() == (WINDOWWIDTH, WINDOWHEIGHT):
+    DISPLAYSURF = WINDOW
+else:
+    DISPLAYSURF = pygame.Surface((WINDOWWIDTH, WINDOWHEIGHT)).convert()
+
+# largest whole-number scale that fits, or the largest scale that fits when
+# scaling smoothly or when the window is smaller than the game
+scale_factor = min(WINDOW.get_width() / WINDOWWIDTH, WINDOW.get_height() / WINDOWHEIGHT)
+if not SMOOTH_SCALING and scale_factor >= 1:
+    scale_factor = int(scale_factor)
+PRESENT_RECT = pygame.Rect(0, 0, int(WINDOWWIDTH * scale_factor), int(WINDOWHEIGHT * scale_factor))
+PRESENT_RECT.center = WINDOW.get_rect().center # letterbox the rest of the window
+PRESENT_SURF = WINDOW.subsurface(PRESENT_RECT)
+PRESENT_STATS = {'frames': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
 FPSCLOCK = pygame.time.Clock() # For syncing the FPS
 
 class Player(pygame.sprite.Sprite):
     '''create Player class'''
-    def __init__(self, player_image, bullet_image, missile_image, sprites_list, bullet_list, bullet_sound, missile_sound):
+    def __init__(self, player_image, bullet_image, missile_image, sprites_list, bullet_list, bullet_sound, missile_sound, targets,
+                 controls=pygame.key.get_pressed, number=0, start_x=WINDOWWIDTH / 2):
         super().__init__()
-        # scale player image 
-        self.image = pygame.transform.scale(player_image, (70, 70))
-        self.image.set_colorkey(BLACK)
+        # player image is scaled and prepared by load_images
+        self.image = player_image
         self.rect = self.image.get_rect()
 
         # sprites list
         self.sprites = sprites_list
+
+        # where the keys come from, the local keyboard or a co-op client
+        self.controls = controls
+        self.number = number
         
         # player starting location
-        self.rect.centerx = WINDOWWIDTH / 2
+        self.start_x = start_x
+        self.rect.centerx = self.start_x
         self.rect.bottom = WINDOWHEIGHT - 10
 
         # player speed attributes
@@ -71,6 +159,7 @@ class Player(pygame.sprite.Sprite):
         self.last_shot = pygame.time.get_ticks()
         self.missile_sound = missile_sound
         self.bullet_sound = bullet_sound
+        self.targets = targets # grid used by homing missiles
 
         # other player attributes
         self.shield = 100
@@ -82,10 +171,10 @@ class Player(pygame.sprite.Sprite):
 
     def update(self):
         '''update the player'''
-        # unhide player
-        if self.hidden and (pygame.time.get_ticks() - self.hide_timer > 1500):
+        # unhide player if there are lives left
+        if self.hidden and self.lives > 0 and (pygame.time.get_ticks() - self.hide_timer > 1500):
             self.hidden = False
-            self.rect.centerx = WINDOWWIDTH / 2
+            self.rect.centerx = self.start_x
             self.rect.bottom = WINDOWHEIGHT - 10
 
         # timer for upgrades
@@ -98,7 +187,7 @@ class Player(pygame.sprite.Sprite):
         self.speedy = 0 
 
         # then check if there is event handling for arrow keys
-        keys = pygame.key.get_pressed()
+        keys = self.controls()
         if keys[pygame.K_LEFT]:
             self.speedx = -9
         if keys[pygame.K_RIGHT]:
@@ -162,11 +251,23 @@ class Player(pygame.sprite.Sprite):
                 self.bullets.add(missile2)
                 self.bullet_sound.play()
                 self.missile_sound.play()
+            if self.upgrade == 4:
+                bullet = Bullet(self.bullet_image, self.rect.centerx, self.rect.top)
+                self.sprites.add(bullet)
+                self.bullets.add(bullet)
+                missile1 = HomingMissile(self.missile_image, self.rect.left, self.rect.centery, self.targets)
+                self.sprites.add(missile1)
+                self.bullets.add(missile1)
+                missile2 = HomingMissile(self.missile_image, self.rect.right, self.rect.centery, self.targets)
+                self.sprites.add(missile2)
+                self.bullets.add(missile2)
+                self.bullet_sound.play()
+                self.missile_sound.play()
 
     def upgrade_power(self):
-        if self.upgrade >= 3:
-            self.upgrade = 3
-        elif self.upgrade < 3:
+        if self.upgrade >= MAX_UPGRADE:
+            self.upgrade = MAX_UPGRADE
+        elif self.upgrade < MAX_UPGRADE:
             self.upgrade += 1
         #print("upgrade:", self.upgrade)
         self.upgrade_timer = pygame.time.get_ticks()
@@ -182,8 +283,8 @@ class EnemyShip(pygame.sprite.Sprite):
     '''create EnemyShip class'''
     def __init__(self, enemy_image, bullet_image, sprites_list, bullet_list, bullet_sound, boost_anim):
         super().__init__()
-        # scale enemy image 
-        self.image = pygame.transform.scale(enemy_image, (60, 60))
+        # enemy image is scaled and prepared by load_images
+        self.image = enemy_image
         self.rect = self.image.get_rect()
 
         # sprites list
@@ -273,9 +374,8 @@ class Bullet(pygame.sprite.Sprite):
     '''create Bullet class'''
     def __init__(self, bullet_image, x, y):
         super().__init__()
-        # scale bullet size
-        self.image = pygame.transform.scale(bullet_image, (8, 23))
-        self.image.set_colorkey(BLACK)
+        # bullet image is scaled and prepared by load_images
+        self.image = bullet_image
         self.rect = self.image.get_rect()
         # bullet position is according the player position
         self.rect.centerx = x
@@ -295,9 +395,8 @@ class EnemyBullet(pygame.sprite.Sprite):
     '''create Enemy Bullet class'''
     def __init__(self, bullet_image, x, y):
         super().__init__()
-        # scale bullet size
-        self.image = pygame.transform.scale(bullet_image, (8, 23))
-        self.image.set_colorkey(BLACK)
+        # bullet image is scaled and prepared by load_images
+        self.image = bullet_image
         self.rect = self.image.get_rect()
         # bullet position is according the player position
         self.rect.centerx = x
@@ -318,7 +417,6 @@ class Missile(pygame.sprite.Sprite):
     def __init__(self, image, x, y):
         super().__init__()
         self.image = image
-        self.image = pygame.transform.scale(image, (25, 38))
         self.rect = self.image.get_rect()
         self.rect.centerx = x
         self.rect.bottom = y
@@ -331,18 +429,111 @@ class Missile(pygame.sprite.Sprite):
             self.kill()
 
 
+class HomingMissile(Missile):
+    '''create HomingMissile class'''
+    def __init__(self, image, x, y, targets):
+        super().__init__(image, x, y)
+        self.image_orig = self.image
+        self.targets = targets
+        # track the position as floats so slow turns are not lost to rounding
+        self.x = float(self.rect.centerx)
+        self.y = float(self.rect.centery)
+        self.speed = 10
+        self.angle = 90 # heading in degrees, 90 is straight up
+        self.turn_rate = 8 # maximum degrees turned per frame
+        self.lifetime = FPS * 3 # frames before the missile burns out
+
+    def update(self):
+        '''steer towards the nearest target'''
+        target = self.targets.nearest(self.x, self.y)
+        if target:
+            desired = math.degrees(math.atan2(self.y - target.rect.centery, target.rect.centerx - self.x))
+            turn = (desired - self.angle + 180) % 360 - 180
+            turn = max(-self.turn_rate, min(self.turn_rate, turn))
+            self.angle = (self.angle + turn) % 360
+
+        heading = math.radians(self.angle)
+        self.x += math.cos(heading) * self.speed
+        self.y -= math.sin(heading) * self.speed
+        self.image = pygame.transform.rotate(self.image_orig, self.angle - 90)
+        self.rect = self.image.get_rect(center=(round(self.x), round(self.y)))
+
+        self.lifetime -= 1
+        if (self.lifetime <= 0 or self.rect.bottom < 35 or self.rect.top > WINDOWHEIGHT
+                or self.rect.right < 0 or self.rect.left > WINDOWWIDTH):
+            self.kill()
+
+
+class TargetGrid():
+    '''uniform grid over the targets for nearest-neighbour queries, rebuilt every frame'''
+    def __init__(self, cell_size=TARGET_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.max_ring = 0
+
+    def rebuild(self, *groups):
+        '''bucket every on-screen sprite of the groups by cell'''
+        self.cells.clear()
+        for group in groups:
+            for sprite in group:
+                if sprite.rect.bottom < 0 or sprite.rect.top > WINDOWHEIGHT:
+                    continue
+                key = (sprite.rect.centerx // self.cell_size, sprite.rect.centery // self.cell_size)
+                if key in self.cells:
+                    self.cells[key].append(sprite)
+                else:
+                    self.cells[key] = [sprite]
+        # no target can be further away than the screen diagonal
+        self.max_ring = (WINDOWWIDTH + WINDOWHEIGHT) // self.cell_size + 1
+
+    def nearest(self, x, y):
+        '''return the closest target to (x, y), or None if there are no targets'''
+        if not self.cells:
+            return None
+        cell_x = int(x // self.cell_size)
+        cell_y = int(y // self.cell_size)
+        best = None
+        best_dist = None
+        for ring in range(self.max_ring + 1):
+            # search the cells on the border of a square ring around the point
+            for dx in range(-ring, ring + 1):
+                if dx == -ring or dx == ring:
+                    dys = range(-ring, ring + 1)
+                else:
+                    dys = (-ring, ring) if ring else (0,)
+                for dy in dys:
+                    for sprite in self.cells.get((cell_x + dx, cell_y + dy), ()):
+                        dist = (sprite.rect.centerx - x) ** 2 + (sprite.rect.centery - y) ** 2
+                        if best is None or dist < best_dist:
+                            best = sprite
+                            best_dist = dist
+            # anything in the next ring is at least ring * cell_size away
+            if best is not None and best_dist <= (ring * self.cell_size) ** 2:
+                break
+        return best
+
+
 class Asteroid(pygame.sprite.Sprite):
     '''create Asteroid class'''
-    def __init__(self, asteroid_img, all_sprites, asteroid_sprites):
+    def __init__(self, asteroid_img, all_sprites, asteroid_sprites, image_index=None, center=None, fragment=False):
         super().__init__()
-        self.image_orig = random.choice(asteroid_img)
+        if image_index is None:
+            image_index = random.randrange(len(asteroid_img))
+        self.image_index = image_index
+        self.image_orig = asteroid_img[self.image_index]
         self.image = self.image_orig.copy()
         self.rect = self.image.get_rect()
         self.radius = int(self.rect.width * .90 / 2)
 
         # set spawn position
-        self.rect.x = random.randrange(-25, WINDOWWIDTH + 25)
-        self.rect.y = random.randrange(-200, -100)
+        if center is None:
+            self.rect.x = random.randrange(-25, WINDOWWIDTH + 25)
+            self.rect.y = random.randrange(-200, -100)
+        else:
+            self.rect.center = center
+
+        # fragments of destroyed asteroids are not respawned
+        self.fragment = fragment
 
         # set asteroid speed x and y values
         self.speedy = random.randrange(5, 12)
@@ -361,6 +552,9 @@ class Asteroid(pygame.sprite.Sprite):
 
         # if asteroids go off the screen, respawn asteroids
         if (self.rect.top > WINDOWHEIGHT + 10) or (self.rect.left < -self.rect.width) or (self.rect.right > WINDOWWIDTH + self.rect.width):
+            if self.fragment:
+                self.kill()
+                return
             self.rect.x = random.randrange(0, WINDOWWIDTH - self.rect.width)
             self.rect.y = random.randrange(-100, -20)
             self.speedy =  random.randrange(3, 10)
@@ -410,7 +604,7 @@ class PowerUp(pygame.sprite.Sprite):
     '''create PowerUp class'''
     def __init__(self, center, powerup_images):
         super().__init__()
-        self.type = random.choice(['shield', 'missile'])
+        self.type = random.choice(POWERUP_TYPES)
         self.image = powerup_images[self.type]
         self.rect = self.image.get_rect()
         # spawn the powerup according to current position of enemy
@@ -429,7 +623,7 @@ class Shield(pygame.sprite.Sprite):
     '''create Shield class'''
     def __init__(self, image, center, player):
         super().__init__()
-        self.image = pygame.transform.scale(image, (85, 85))
+        self.image = image
         self.center = center
         self.rect = self.image.get_rect(center=(self.center))
         self.player = player
@@ -444,7 +638,871 @@ class Shield(pygame.sprite.Sprite):
         elif self.player.shield > 30:
             self.rect.centerx = self.player.rect.centerx
             self.rect.centery = self.player.rect.centery
-        
+
+
+class ParticleSystem():
+    '''debris particles simulated and drawn in batches with NumPy arrays'''
+    def __init__(self, capacity=MAX_PARTICLES):
+        self.capacity = capacity
+        # live particles are kept packed at the front of the arrays
+        self.count = 0
+        self.positions = np.zeros((capacity, 2), np.float32)
+        self.velocities = np.zeros((capacity, 2), np.float32)
+        self.life = np.zeros(capacity, np.int16)
+        self.max_life = 25
+        self.rng = np.random.default_rng()
+        self.palette = None
+
+        # fraction of the requested particles that are emitted, lowered
+        # while frames take longer than the frame budget
+        self.budget = 1.0
+
+    def emit(self, center, amount):
+        '''spray particles out from a point'''
+        amount = min(int(amount * self.budget), self.capacity - self.count)
+        if amount <= 0:
+            return
+        new = slice(self.count, self.count + amount)
+        angles = self.rng.uniform(0, 2 * math.pi, amount)
+        speeds = self.rng.uniform(1, 7, amount)
+        self.positions[new] = center
+        self.velocities[new, 0] = np.cos(angles) * speeds
+        self.velocities[new, 1] = np.sin(angles) * speeds
+        self.life[new] = self.rng.integers(self.max_life // 2, self.max_life + 1, amount)
+        self.count += amount
+
+    def update(self):
+        '''move particles and drop the ones that have burnt out'''
+        live = slice(0, self.count)
+        self.positions[live] += self.velocities[live]
+        self.velocities[live] *= 0.95 # drag
+        self.life[live] -= 1
+
+        alive = np.flatnonzero(self.life[live] > 0)
+        if len(alive) < self.count:
+            self.count = len(alive)
+            self.positions[:self.count] = self.positions[alive]
+            self.velocities[:self.count] = self.velocities[alive]
+            self.life[:self.count] = self.life[alive]
+
+    def draw(self, surface):
+        '''write every particle to the surface as a 2x2 block of pixels'''
+        if self.count == 0:
+            return
+        if self.palette is None:
+            self.palette = np.array([surface.map_rgb(color) for color in PARTICLE_COLORS])
+
+        x = self.positions[:self.count, 0].astype(np.intp)
+        y = self.positions[:self.count, 1].astype(np.intp)
+        width, height = surface.get_size()
+        on_screen = (x >= 0) & (x < width - 1) & (y >= 0) & (y < height - 1)
+        x = x[on_screen]
+        y = y[on_screen]
+        shade = self.life[:self.count][on_screen] * (len(PARTICLE_COLORS) - 1) // self.max_life
+        colors = self.palette[shade]
+
+        pixels = pygame.surfarray.pixels2d(surface)
+        pixels[x, y] = colors
+        pixels[x + 1, y] = colors
+        pixels[x, y + 1] = colors
+        pixels[x + 1, y + 1] = colors
+        del pixels # unlock the surface
+
+    def adjust_budget(self, frame_time):
+        '''emit fewer particles while frame_time (ms) runs over the frame budget'''
+        if frame_time > 1000 / FPS:
+            self.budget = max(0.1, self.budget * 0.8)
+        else:
+            self.budget = min(1.0, self.budget + 0.02)
+
+    def clear(self):
+        self.count = 0
+
+
+#### World snapshots ####
+# A snapshot is a flat byte string: a header followed by one fixed-size
+# record per entity. Only the state needed to rebuild the sprites is stored,
+# explosions and boosts are cosmetic and are not captured.
+SNAPSHOT_VERSION = 4
+# version, score, player x, player y, shield, lives, hidden, upgrade,
+# ms since hide timer, ms since upgrade timer, then the entity counts
+SNAPSHOT_HEADER = struct.Struct('<BihhhBBBIIHHHHH')
+# centerx, centery, speedx, speedy, angle, rotation speed, image index, fragment
+ASTEROID_RECORD = struct.Struct('<hhbbhbBB')
+# centerx, bottom
+ENEMY_RECORD = struct.Struct('<hh')
+# centerx, bottom (centery for homing missiles), kind
+# (0 = bullet, 1 = missile, 2 = homing missile), heading, frames of
+# homing missile lifetime left
+BULLET_RECORD = struct.Struct('<hhBhB')
+# centerx, bottom
+ENEMY_BULLET_RECORD = struct.Struct('<hh')
+# centerx, centery, powerup type index
+POWERUP_RECORD = struct.Struct('<hhB')
+
+
+class SnapshotRing():
+    '''fixed-size ring buffer of world snapshots'''
+    def __init__(self, size):
+        self.slots = [None] * size
+        self.head = 0 # index of the next slot to write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, snapshot):
+        '''store a snapshot, overwriting the oldest one when full'''
+        self.slots[self.head] = snapshot
+        self.head = (self.head + 1) % len(self.slots)
+        self.count = min(self.count + 1, len(self.slots))
+
+    def pop(self):
+        '''remove and return the newest snapshot'''
+        self.head = (self.head - 1) % len(self.slots)
+        self.count -= 1
+        snapshot = self.slots[self.head]
+        self.slots[self.head] = None
+        return snapshot
+
+    def latest(self):
+        '''return the newest snapshot without removing it'''
+        return self.slots[(self.head - 1) % len(self.slots)]
+
+    def clear(self):
+        self.slots = [None] * len(self.slots)
+        self.head = 0
+        self.count = 0
+
+
+def capture_world(score, player, groups):
+    '''pack the game state into a snapshot'''
+    current_time = pygame.time.get_ticks()
+    asteroids = groups['asteroids'].sprites()
+    enemy_ships = groups['enemy_ships'].sprites()
+    bullets = groups['bullets'].sprites()
+    enemy_bullets = groups['enemy_bullets'].sprites()
+    powerups = groups['powerups'].sprites()
+
+    size = (SNAPSHOT_HEADER.size + len(asteroids) * ASTEROID_RECORD.size
+            + len(enemy_ships) * ENEMY_RECORD.size + len(bullets) * BULLET_RECORD.size
+            + len(enemy_bullets) * ENEMY_BULLET_RECORD.size + len(powerups) * POWERUP_RECORD.size)
+    snapshot = bytearray(size)
+
+    SNAPSHOT_HEADER.pack_into(snapshot, 0, SNAPSHOT_VERSION, score,
+                              player.rect.x, player.rect.y, player.shield, player.lives,
+                              player.hidden, player.upgrade,
+                              max(0, current_time - player.hide_timer),
+                              max(0, current_time - player.upgrade_timer),
+                              len(asteroids), len(enemy_ships), len(bullets),
+                              len(enemy_bullets), len(powerups))
+    offset = SNAPSHOT_HEADER.size
+    for asteroid in asteroids:
+        ASTEROID_RECORD.pack_into(snapshot, offset, asteroid.rect.centerx, asteroid.rect.centery,
+                                  asteroid.speedx, asteroid.speedy, asteroid.angle,
+                                  asteroid.rotation_speed, asteroid.image_index, asteroid.fragment)
+        offset += ASTEROID_RECORD.size
+    for enemy in enemy_ships:
+        ENEMY_RECORD.pack_into(snapshot, offset, enemy.rect.centerx, enemy.rect.bottom)
+        offset += ENEMY_RECORD.size
+    for bullet in bullets:
+        if isinstance(bullet, HomingMissile):
+            BULLET_RECORD.pack_into(snapshot, offset, round(bullet.x), round(bullet.y), 2,
+                                    round(bullet.angle), max(0, bullet.lifetime))
+        else:
+            BULLET_RECORD.pack_into(snapshot, offset, bullet.rect.centerx, bullet.rect.bottom,
+                                    isinstance(bullet, Missile), 90, 0)
+        offset += BULLET_RECORD.size
+    for bullet in enemy_bullets:
+        ENEMY_BULLET_RECORD.pack_into(snapshot, offset, bullet.rect.centerx, bullet.rect.bottom)
+        offset += ENEMY_BULLET_RECORD.size
+    for powerup in powerups:
+        POWERUP_RECORD.pack_into(snapshot, offset, powerup.rect.centerx, powerup.rect.centery,
+                                 POWERUP_TYPES.index(powerup.type))
+        offset += POWERUP_RECORD.size
+
+    return bytes(snapshot)
+
+def restore_world(snapshot, player, groups, assets):
+    '''rebuild the game state from a snapshot and return the score'''
+    if len(snapshot) < SNAPSHOT_HEADER.size:
+        raise ValueError('snapshot is too short')
+    (version, score, player_x, player_y, shield, lives, hidden, upgrade, hide_age, upgrade_age,
+     num_asteroids, num_enemies, num_bullets, num_enemy_bullets,
+     num_powerups) = SNAPSHOT_HEADER.unpack_from(snapshot, 0)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError('unsupported snapshot version: {}'.format(version))
+
+    # check the whole snapshot before changing anything, so a corrupt
+    # save leaves the current game untouched
+    if lives == 0:
+        raise ValueError('snapshot has no lives left')
+    if not 1 <= upgrade <= MAX_UPGRADE:
+        raise ValueError('invalid upgrade level: {}'.format(upgrade))
+    if hidden > 1:
+        raise ValueError('invalid hidden flag: {}'.format(hidden))
+    size = (SNAPSHOT_HEADER.size + num_asteroids * ASTEROID_RECORD.size
+            + num_enemies * ENEMY_RECORD.size + num_bullets * BULLET_RECORD.size
+            + num_enemy_bullets * ENEMY_BULLET_RECORD.size + num_powerups * POWERUP_RECORD.size)
+    if len(snapshot) != size:
+        raise ValueError('snapshot is {} bytes, expected {}'.format(len(snapshot), size))
+    offset = SNAPSHOT_HEADER.size
+    for i in range(num_asteroids):
+        image_index = ASTEROID_RECORD.unpack_from(snapshot, offset)[6]
+        offset += ASTEROID_RECORD.size
+        if image_index >= len(assets['asteroid_images']):
+            raise ValueError('invalid asteroid image: {}'.format(image_index))
+    offset += num_enemies * ENEMY_RECORD.size
+    for i in range(num_bullets):
+        kind = BULLET_RECORD.unpack_from(snapshot, offset)[2]
+        offset += BULLET_RECORD.size
+        if kind > 2:
+            raise ValueError('invalid bullet kind: {}'.format(kind))
+    offset += num_enemy_bullets * ENEMY_BULLET_RECORD.size
+    for i in range(num_powerups):
+        type_index = POWERUP_RECORD.unpack_from(snapshot, offset)[2]
+        offset += POWERUP_RECORD.size
+        if type_index >= len(POWERUP_TYPES):
+            raise ValueError('invalid powerup type: {}'.format(type_index))
+
+    current_time = pygame.time.get_ticks()
+    all_sprites = groups['all_sprites']
+
+    # remove everything except the player and its shield
+    for sprite in all_sprites.sprites():
+        if not isinstance(sprite, (Player, Shield)):
+            sprite.kill()
+
+    player.rect.x = player_x
+    player.rect.y = player_y
+    player.shield = shield
+    player.lives = lives
+    player.hidden = bool(hidden)
+    player.upgrade = upgrade
+    player.hide_timer = current_time - hide_age
+    player.upgrade_timer = current_time - upgrade_age
+
+    offset = SNAPSHOT_HEADER.size
+    for i in range(num_asteroids):
+        (centerx, centery, speedx, speedy, angle, rotation_speed,
+         image_index, fragment) = ASTEROID_RECORD.unpack_from(snapshot, offset)
+        offset += ASTEROID_RECORD.size
+        asteroid = Asteroid(assets['asteroid_images'], all_sprites, groups['asteroids'],
+                            image_index, (centerx, centery), bool(fragment))
+        asteroid.image = pygame.transform.rotate(asteroid.image_orig, angle)
+        asteroid.rect = asteroid.image.get_rect(center=(centerx, centery))
+        asteroid.speedx = speedx
+        asteroid.speedy = speedy
+        asteroid.angle = angle
+        asteroid.rotation_speed = rotation_speed
+        all_sprites.add(asteroid)
+        groups['asteroids'].add(asteroid)
+
+    for i in range(num_enemies):
+        centerx, bottom = ENEMY_RECORD.unpack_from(snapshot, offset)
+        offset += ENEMY_RECORD.size
+        enemy_ship = EnemyShip(assets['enemy_img'], assets['enemy_bullet_img'], all_sprites,
+                               groups['enemy_bullets'], assets['enemy_bullet_sound'],
+                               assets['boost_anim'])
+        enemy_ship.rect.centerx = centerx
+        enemy_ship.rect.bottom = bottom
+        all_sprites.add(enemy_ship)
+        groups['enemy_ships'].add(enemy_ship)
+
+    for i in range(num_bullets):
+        centerx, bottom, kind, angle, lifetime = BULLET_RECORD.unpack_from(snapshot, offset)
+        offset += BULLET_RECORD.size
+        if kind == 2:
+            bullet = HomingMissile(player.missile_image, centerx, bottom, player.targets)
+            bullet.x = centerx
+            bullet.y = bottom
+            bullet.angle = angle
+            bullet.lifetime = lifetime
+            bullet.rect.center = (centerx, bottom)
+        elif kind == 1:
+            bullet = Missile(player.missile_image, centerx, bottom)
+        else:
+            bullet = Bullet(player.bullet_image, centerx, bottom)
+        all_sprites.add(bullet)
+        groups['bullets'].add(bullet)
+
+    for i in range(num_enemy_bullets):
+        centerx, bottom = ENEMY_BULLET_RECORD.unpack_from(snapshot, offset)
+        offset += ENEMY_BULLET_RECORD.size
+        bullet = EnemyBullet(assets['enemy_bullet_img'], centerx, bottom)
+        all_sprites.add(bullet)
+        groups['enemy_bullets'].add(bullet)
+
+    for i in range(num_powerups):
+        centerx, centery, type_index = POWERUP_RECORD.unpack_from(snapshot, offset)
+        offset += POWERUP_RECORD.size
+        powerup = PowerUp((centerx, centery), assets['powerup_images'])
+        powerup.type = POWERUP_TYPES[type_index]
+        powerup.image = assets['powerup_images'][powerup.type]
+        powerup.rect = powerup.image.get_rect(center=(centerx, centery))
+        all_sprites.add(powerup)
+        groups['powerups'].add(powerup)
+
+    return score
+
+def save_snapshot(filename, snapshot):
+    '''write a snapshot to disk'''
+    with open(filename, 'wb') as f:
+        f.write(snapshot)
+
+def load_snapshot(filename):
+    '''read a snapshot from disk'''
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+#### Frame capture ####
+class FrameRecorder():
+    '''copy frames into preallocated buffers and encode them on a worker thread'''
+    def __init__(self, size, directory, encoding=CAPTURE_ENCODING, num_buffers=CAPTURE_BUFFERS):
+        self.size = size
+        self.directory = directory
+        self.encoding = encoding
+        makedirs(self.directory, exist_ok=True)
+
+        # each buffer is wrapped once in a surface with a fixed RGBX layout, so
+        # capturing is a single blit and the encoder does not depend on the
+        # display pixel format
+        self.buffers = [bytearray(size[0] * size[1] * 4) for i in range(num_buffers)]
+        self.surfaces = [pygame.image.frombuffer(buffer, size, 'RGBX') for buffer in self.buffers]
+
+        # indices of buffers ready to be filled and buffers waiting to be encoded
+        self.free_buffers = queue.Queue()
+        for i in range(num_buffers):
+            self.free_buffers.put(i)
+        self.pending_frames = queue.Queue()
+
+        self.frames_captured = 0
+        self.frames_dropped = 0
+
+        self.worker = threading.Thread(target=self.encode, daemon=True)
+        self.worker.start()
+        # write the queued frames however the game exits
+        atexit.register(self.stop, True)
+
+    def capture(self, surface):
+        '''copy a frame, dropping it if every buffer is still waiting to be encoded'''
+        try:
+            index = self.free_buffers.get_nowait()
+        except queue.Empty:
+            self.frames_dropped += 1
+            return
+        self.surfaces[index].blit(surface, (0, 0))
+        # number frames by game frame so dropped frames leave gaps
+        self.pending_frames.put((index, self.frames_captured + self.frames_dropped))
+        self.frames_captured += 1
+
+    def encode(self):
+        '''worker loop writing captured frames to disk'''
+        raw_file = None
+        if self.encoding == 'raw':
+            # play back with e.g. ffmpeg -f rawvideo -pixel_format rgb0
+            # -video_size 480x600 -framerate 30 -i capture.rgbx
+            raw_file = open(path.join(self.directory, 'capture.rgbx'), 'wb')
+
+        next_number = 0
+        while True:
+            item = self.pending_frames.get()
+            if item is None:
+                break
+            index, number = item
+            if raw_file:
+                # repeat the frame in place of any dropped before it so the
+                # video keeps the game's timing
+                for i in range(number - next_number + 1):
+                    raw_file.write(self.buffers[index])
+            else:
+                pygame.image.save(self.surfaces[index], path.join(self.directory, 'frame{:05d}.png'.format(number)))
+            next_number = number + 1
+            self.free_buffers.put(index)
+
+        if raw_file:
+            raw_file.close()
+        print("Recorded {} frames to {} ({} dropped)".format(
+            self.frames_captured, self.directory, self.frames_dropped))
+
+    def stop(self, wait=False):
+        '''stop recording, the worker finishes the queued frames in the background'''
+        atexit.unregister(self.stop)
+        self.pending_frames.put(None)
+        if wait:
+            self.worker.join()
+
+
+#### Presenting frames ####
+def present():
+    '''scale the framebuffer to the window and show it'''
+    start = perf_counter()
+    if DISPLAYSURF is not WINDOW:
+        if SMOOTH_SCALING:
+            pygame.transform.smoothscale(DISPLAYSURF, PRESENT_RECT.size, PRESENT_SURF)
+        else:
+            pygame.transform.scale(DISPLAYSURF, PRESENT_RECT.size, PRESENT_SURF)
+    present_ms = (perf_counter() - start) * 1000
+    PRESENT_STATS['frames'] += 1
+    PRESENT_STATS['total_ms'] += present_ms
+    PRESENT_STATS['max_ms'] = max(PRESENT_STATS['max_ms'], present_ms)
+    pygame.display.flip()
+
+def print_present_stats():
+    '''report how long scaling frames to the window took'''
+    if PRESENT_STATS['frames']:
+        print("Present: {}x{} -> {}x{}, {:.3f} ms average, {:.3f} ms worst over {} frames".format(
+            WINDOWWIDTH, WINDOWHEIGHT, PRESENT_RECT.width, PRESENT_RECT.height,
+            PRESENT_STATS['total_ms'] / PRESENT_STATS['frames'], PRESENT_STATS['max_ms'],
+            PRESENT_STATS['frames']))
+
+# report on every way out of the game: the menu, game over, the window or errors
+atexit.register(print_present_stats)
+
+
+#### Networked co-op ####
+# The host runs the only simulation. The client sends its keys every frame and
+# receives quantized snapshots of every entity, delta compressed against the
+# last snapshot it acknowledged: unchanged entities are left out and moved ones
+# only carry their position change. The client interpolates between snapshots.
+NET_INPUT = 1
+NET_SNAPSHOT = 2
+# entity kinds sent to the client
+(NET_PLAYER, NET_SHIELD, NET_ENEMY, NET_ASTEROID, NET_BULLET, NET_MISSILE,
+ NET_ENEMY_BULLET, NET_POWERUP, NET_EXPLOSION, NET_BOOST) = range(10)
+# packet type, client time, newest snapshot received, key bits
+NET_INPUT_PACKET = struct.Struct('<BIIB')
+# packet type, sequence, baseline sequence (0 = full snapshot), host time,
+# echoed client time, ms the host held that input before this snapshot,
+# score, shield and lives of both players, then the number of changed and
+# removed entities
+NET_SNAPSHOT_HEADER = struct.Struct('<BIIIIHihBhBHH')
+# every changed entity starts with its id and flags saying which fields follow
+NET_ENTITY_HEADER = struct.Struct('<HB')
+NET_FULL = 1 # kind, variant, centerx, centery and frame follow
+NET_MOVED = 2 # the position change since the baseline follows
+NET_FRAME = 4 # the new frame or quantized angle follows
+# kind, variant, centerx, centery, frame or quantized angle
+NET_FULL_RECORD = struct.Struct('<BBhhB')
+# change in centerx and centery since the baseline
+NET_MOVE_RECORD = struct.Struct('<bb')
+# frame or quantized angle
+NET_FRAME_RECORD = struct.Struct('<B')
+# id
+NET_REMOVED_RECORD = struct.Struct('<H')
+
+def quantize_angle(angle):
+    '''pack an angle in degrees into a byte'''
+    return int(round(angle * 256 / 360)) % 256
+
+def net_entity(sprite):
+    '''return the kind, variant and frame a client needs to draw a sprite'''
+    if isinstance(sprite, Player):
+        return NET_PLAYER, sprite.number, 0
+    if isinstance(sprite, Shield):
+        return NET_SHIELD, 0, 0
+    if isinstance(sprite, EnemyShip):
+        return NET_ENEMY, 0, 0
+    if isinstance(sprite, Asteroid):
+        return NET_ASTEROID, sprite.image_index, quantize_angle(sprite.angle)
+    if isinstance(sprite, HomingMissile):
+        return NET_MISSILE, 0, quantize_angle(sprite.angle)
+    if isinstance(sprite, Missile):
+        return NET_MISSILE, 0, quantize_angle(90)
+    if isinstance(sprite, Bullet):
+        return NET_BULLET, 0, 0
+    if isinstance(sprite, EnemyBullet):
+        return NET_ENEMY_BULLET, 0, 0
+    if isinstance(sprite, PowerUp):
+        return NET_POWERUP, POWERUP_TYPES.index(sprite.type), 0
+    if isinstance(sprite, Explosion):
+        return NET_EXPLOSION, EXPLOSION_TYPES.index(sprite.ex_type), sprite.frame
+    if isinstance(sprite, Boost):
+        return NET_BOOST, 0, sprite.frame
+    return None
+
+
+class NetStats():
+    '''bandwidth and latency counters for a connection'''
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.packets_in = 0
+        self.packets_out = 0
+        self.latency = None # round trip time in ms
+
+        # KB/s over the last full second
+        self.rate_in = 0.0
+        self.rate_out = 0.0
+        self.window_start = pygame.time.get_ticks()
+        self.window_in = 0
+        self.window_out = 0
+
+    def sent(self, size):
+        self.bytes_out += size
+        self.packets_out += 1
+        self.window_out += size
+
+    def received(self, size):
+        self.bytes_in += size
+        self.packets_in += 1
+        self.window_in += size
+
+    def update(self):
+        '''recalculate the rates once a second'''
+        elapsed = pygame.time.get_ticks() - self.window_start
+        if elapsed >= 1000:
+            self.rate_in = self.window_in / 1024 * 1000 / elapsed
+            self.rate_out = self.window_out / 1024 * 1000 / elapsed
+            self.window_start += elapsed
+            self.window_in = 0
+            self.window_out = 0
+
+    def text(self):
+        latency = '--' if self.latency is None else str(self.latency)
+        return "RTT {} ms  IN {:.1f} KB/s  OUT {:.1f} KB/s".format(latency, self.rate_in, self.rate_out)
+
+
+class NetServer():
+    '''authoritative host that sends snapshots to a co-op client'''
+    def __init__(self, port=NET_PORT):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(('', port))
+        self.client = None # address of the client currently connected
+        self.last_heard = 0
+
+        # latest input from the client
+        self.keys = {key: False for key in NET_KEYS}
+        self.client_time = 0
+        self.input_time = 0 # when the latest input arrived
+        self.acked = 0
+
+        # snapshots already sent, by sequence number
+        self.sequence = 0
+        self.sent_snapshots = {}
+        self.next_id = 1
+        self.stats = NetStats()
+
+    def controls(self):
+        '''keys pressed on the client, used in place of pygame.key.get_pressed'''
+        return self.keys
+
+    def disconnect(self):
+        '''forget the client, releasing the keys its ship was holding'''
+        self.client = None
+        for key in self.keys:
+            self.keys[key] = False
+        self.acked = 0
+        self.sent_snapshots.clear()
+
+    def receive(self):
+        '''read every waiting input packet'''
+        current_time = pygame.time.get_ticks()
+        while True:
+            try:
+                data, address = self.socket.recvfrom(2048)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue
+            if len(data) != NET_INPUT_PACKET.size:
+                continue
+            packet_type, client_time, acked, bits = NET_INPUT_PACKET.unpack(data)
+            if packet_type != NET_INPUT:
+                continue
+            if self.client is None:
+                self.disconnect() # start the new client from a full snapshot
+                self.client = address
+            if address != self.client:
+                continue
+            self.last_heard = current_time
+            self.stats.received(len(data))
+            for i, key in enumerate(NET_KEYS):
+                self.keys[key] = bool(bits & (1 << i))
+            self.client_time = client_time
+            self.input_time = current_time
+            if acked == 0:
+                # a restarted client has no baselines
+                self.acked = 0
+            else:
+                self.acked = max(self.acked, acked) # packets may arrive out of order
+
+        # let another client join once this one goes quiet
+        if self.client is not None and current_time - self.last_heard > NET_TIMEOUT:
+            self.disconnect()
+
+    def entity_id(self, sprite):
+        '''give every sprite a small id that stays the same between snapshots'''
+        if not hasattr(sprite, 'net_id'):
+            sprite.net_id = self.next_id
+            self.next_id = self.next_id % 65535 + 1
+        return sprite.net_id
+
+    def encode_entity(self, net_id, entity, previous):
+        '''pack an entity as the fields that changed since previous, or in full'''
+        kind, variant, x, y, frame = entity
+        if previous is not None and previous[:2] == (kind, variant):
+            dx = x - previous[2]
+            dy = y - previous[3]
+            if -128 <= dx <= 127 and -128 <= dy <= 127:
+                flags = 0
+                record = b''
+                if dx or dy:
+                    flags |= NET_MOVED
+                    record += NET_MOVE_RECORD.pack(dx, dy)
+                if frame != previous[4]:
+                    flags |= NET_FRAME
+                    record += NET_FRAME_RECORD.pack(frame)
+                return NET_ENTITY_HEADER.pack(net_id, flags) + record
+        return NET_ENTITY_HEADER.pack(net_id, NET_FULL) + NET_FULL_RECORD.pack(kind, variant, x, y, frame)
+
+    def send_snapshot(self, score, players, sprites):
+        '''send every entity that changed since the last acknowledged snapshot'''
+        if self.client is None:
+            return
+        entities = {}
+        for sprite in sprites:
+            entity = net_entity(sprite)
+            if entity:
+                kind, variant, frame = entity
+                entities[self.entity_id(sprite)] = (kind, variant, sprite.rect.centerx,
+                                                    sprite.rect.centery, frame)
+
+        self.sequence += 1
+        self.sent_snapshots[self.sequence] = entities
+        self.sent_snapshots.pop(self.sequence - NET_HISTORY, None)
+
+        # fall back to a full snapshot when the client is too far behind
+        baseline_sequence = self.acked if self.acked in self.sent_snapshots else 0
+        baseline = self.sent_snapshots.get(baseline_sequence, {})
+        changed = [(net_id, entity) for net_id, entity in entities.items() if baseline.get(net_id) != entity]
+        removed = [net_id for net_id in baseline if net_id not in entities]
+
+        host, guest = players[0], players[-1]
+        current_time = pygame.time.get_ticks()
+        # report how long the input waited here so the client can leave it out of the RTT
+        held = min(current_time - self.input_time, 65535)
+        packet = bytearray(NET_SNAPSHOT_HEADER.pack(NET_SNAPSHOT, self.sequence, baseline_sequence,
+                                                    current_time, self.client_time, held, score,
+                                                    host.shield, host.lives, guest.shield, guest.lives,
+                                                    len(changed), len(removed)))
+        for net_id, entity in changed:
+            packet += self.encode_entity(net_id, entity, baseline.get(net_id))
+        for net_id in removed:
+            packet += NET_REMOVED_RECORD.pack(net_id)
+
+        self.socket.sendto(packet, self.client)
+        self.stats.sent(len(packet))
+
+    def close(self):
+        self.socket.close()
+
+
+class NetClient():
+    '''co-op client that sends keys to the host and interpolates its snapshots'''
+    def __init__(self, host, port, valid_entity):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        # resolved once so replies can be matched against it
+        self.address = (socket.gethostbyname(host), port)
+        self.valid_entity = valid_entity # checks a received entity can be drawn
+
+        # decoded snapshots by sequence number, used as delta baselines
+        self.snapshots = {}
+        self.latest = 0
+
+        # (host time, entities, hud values) of the newest snapshots
+        self.states = []
+        self.time_offset = 0 # host time minus local time
+        self.stats = NetStats()
+
+    def send_input(self, keys):
+        '''send the pressed keys and acknowledge the newest snapshot'''
+        bits = 0
+        for i, key in enumerate(NET_KEYS):
+            if keys[key]:
+                bits |= 1 << i
+        packet = NET_INPUT_PACKET.pack(NET_INPUT, pygame.time.get_ticks(), self.latest, bits)
+        try:
+            self.socket.sendto(packet, self.address)
+            self.stats.sent(len(packet))
+        except OSError:
+            pass # the host may not be up yet
+
+    def receive(self):
+        '''read every waiting snapshot'''
+        while True:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except BlockingIOError:
+                break
+            except ConnectionResetError:
+                continue
+            if address != self.address:
+                continue # not from the host
+            self.stats.received(len(data))
+            self.decode(data)
+
+    def decode(self, data):
+        '''apply a snapshot to the baseline it was compressed against'''
+        if len(data) < NET_SNAPSHOT_HEADER.size:
+            return
+        (packet_type, sequence, baseline, host_time, client_time, held, score, host_shield, host_lives,
+         guest_shield, guest_lives, num_changed, num_removed) = NET_SNAPSHOT_HEADER.unpack_from(data, 0)
+        if packet_type != NET_SNAPSHOT:
+            return
+        # a full snapshot far behind the newest one means the host restarted
+        if baseline == 0 and sequence <= self.latest - NET_HISTORY:
+            self.snapshots = {}
+            self.latest = 0
+            self.states = []
+        # drop late packets and deltas against baselines we no longer have
+        if sequence <= self.latest:
+            return
+        if baseline and baseline not in self.snapshots:
+            return
+
+        entities = dict(self.snapshots[baseline]) if baseline else {}
+        offset = NET_SNAPSHOT_HEADER.size
+        try:
+            for i in range(num_changed):
+                net_id, flags = NET_ENTITY_HEADER.unpack_from(data, offset)
+                offset += NET_ENTITY_HEADER.size
+                if flags & NET_FULL:
+                    kind, variant, x, y, frame = NET_FULL_RECORD.unpack_from(data, offset)
+                    offset += NET_FULL_RECORD.size
+                elif net_id in entities:
+                    kind, variant, x, y, frame = entities[net_id]
+                    if flags & NET_MOVED:
+                        dx, dy = NET_MOVE_RECORD.unpack_from(data, offset)
+                        offset += NET_MOVE_RECORD.size
+                        x += dx
+                        y += dy
+                    if flags & NET_FRAME:
+                        frame, = NET_FRAME_RECORD.unpack_from(data, offset)
+                        offset += NET_FRAME_RECORD.size
+                else:
+                    return # a change to an entity the baseline does not have
+                if not self.valid_entity(kind, variant, frame):
+                    return # corrupt packet, it would fail to draw
+                entities[net_id] = (kind, variant, x, y, frame)
+            for i in range(num_removed):
+                net_id, = NET_REMOVED_RECORD.unpack_from(data, offset)
+                offset += NET_REMOVED_RECORD.size
+                entities.pop(net_id, None)
+        except struct.error:
+            return # truncated packet
+
+        self.snapshots[sequence] = entities
+        for old in [old for old in self.snapshots if old <= sequence - NET_HISTORY]:
+            del self.snapshots[old]
+        self.latest = sequence
+
+        current_time = pygame.time.get_ticks()
+        # round trip time without the time the host held the input
+        self.stats.latency = max(0, current_time - client_time - held)
+        # smooth the clock offset so jitter does not make entities stutter
+        if not self.states:
+            self.time_offset = host_time - current_time
+        else:
+            self.time_offset += (host_time - current_time - self.time_offset) * 0.1
+        hud = (score, host_shield, host_lives, guest_shield, guest_lives)
+        self.states.append((host_time, entities, hud))
+        self.states = self.states[-10:]
+
+    def state(self):
+        '''return the entities and hud values NET_INTERP_DELAY ms behind the host'''
+        if not self.states:
+            return None, None
+        render_time = pygame.time.get_ticks() + self.time_offset - NET_INTERP_DELAY
+        for i, (host_time, entities, hud) in enumerate(self.states):
+            if host_time >= render_time:
+                break
+        else:
+            # nothing newer has arrived yet, hold the newest snapshot
+            return list(self.states[-1][1].values()), self.states[-1][2]
+        if i == 0:
+            return list(entities.values()), hud
+
+        older_time, older_entities = self.states[i - 1][:2]
+        t = (render_time - older_time) / max(1, host_time - older_time)
+        interpolated = []
+        for net_id, (kind, variant, x, y, frame) in entities.items():
+            previous = older_entities.get(net_id)
+            if previous and previous[0] == kind:
+                x = previous[2] + (x - previous[2]) * t
+                y = previous[3] + (y - previous[3]) * t
+            interpolated.append((kind, variant, x, y, frame))
+        return interpolated, hud
+
+    def close(self):
+        self.socket.close()
+
+
+class NetSpriteImages():
+    '''images for drawing the entities received from the host'''
+    def __init__(self, images):
+        self.images = images
+        self.cache = {}
+
+        # the same prepared images the sprites on the host use
+        self.player = images['player_img']
+        self.shield = images['energy_shield']
+        self.enemy = images['enemy_img']
+        self.bullet = images['bullet_img']
+        self.enemy_bullet = images['enemy_bullet_img']
+        self.missile = images['missile_img']
+
+    def get(self, kind, variant, frame):
+        '''return the image for an entity, rotating it once per angle'''
+        key = (kind, variant, frame)
+        if key not in self.cache:
+            self.cache[key] = self.make(kind, variant, frame)
+        return self.cache[key]
+
+    def valid(self, kind, variant, frame):
+        '''check an entity received from the host has an image'''
+        if kind == NET_PLAYER:
+            return variant < 2 and frame == 0
+        if kind in (NET_SHIELD, NET_ENEMY, NET_BULLET, NET_ENEMY_BULLET):
+            return variant == 0 and frame == 0
+        if kind == NET_ASTEROID:
+            return variant < len(self.images['asteroid_images']) # any angle
+        if kind == NET_MISSILE:
+            return variant == 0 # any angle
+        if kind == NET_POWERUP:
+            return variant < len(POWERUP_TYPES) and frame == 0
+        if kind == NET_EXPLOSION:
+            return (variant < len(EXPLOSION_TYPES)
+                    and frame < len(self.images['explosion_anim'][EXPLOSION_TYPES[variant]]))
+        if kind == NET_BOOST:
+            return variant == 0 and frame < len(self.images['boost_anim']['boost'])
+        return False
+
+    def make(self, kind, variant, frame):
+        angle = frame * 360 / 256
+        if kind == NET_PLAYER:
+            return self.player
+        if kind == NET_SHIELD:
+            return self.shield
+        if kind == NET_ENEMY:
+            return self.enemy
+        if kind == NET_ASTEROID:
+            return pygame.transform.rotate(self.images['asteroid_images'][variant], angle)
+        if kind == NET_BULLET:
+            return self.bullet
+        if kind == NET_MISSILE:
+            return pygame.transform.rotate(self.missile, angle - 90)
+        if kind == NET_ENEMY_BULLET:
+            return self.enemy_bullet
+        if kind == NET_POWERUP:
+            return self.images['powerup_images'][POWERUP_TYPES[variant]]
+        if kind == NET_EXPLOSION:
+            return self.images['explosion_anim'][EXPLOSION_TYPES[variant]][frame]
+        return self.images['boost_anim']['boost'][frame]
+
 
 def draw_text(surface, text, size, x, y, color):
     '''draw text to screen'''
@@ -459,16 +1517,13 @@ def menu():
     pygame.mixer.music.load(path.join(sound_dir, 'SpaceShooter_Theme.wav'))
     pygame.mixer.music.play(-1)
     
-    title = pygame.image.load(path.join(img_dir, "The_Lonely_Shooter.png")).convert_alpha()
-    title = pygame.transform.scale(title, (WINDOWWIDTH, 81 * 2))
-    background = pygame.image.load('images/stars_bg.jpeg').convert()
+    title = prepare_image(pygame.image.load(path.join(img_dir, "The_Lonely_Shooter.png")), (WINDOWWIDTH, 81 * 2))
+    background = prepare_image(pygame.image.load(path.join(img_dir, 'stars_bg.jpeg')), transparency='opaque')
     background_rect = background.get_rect()
 
     # display instructions for game
-    arrow_keys = pygame.image.load(path.join(img_dir, 'arrowkeys.png')).convert_alpha()
-    arrow_keys = pygame.transform.scale(arrow_keys, (150, 85))
-    spacebar = pygame.image.load(path.join(img_dir, 'spacebar.png')).convert_alpha()
-    spacebar = pygame.transform.scale(spacebar, (150, 50))
+    arrow_keys = prepare_image(pygame.image.load(path.join(img_dir, 'arrowkeys.png')), (150, 85))
+    spacebar = prepare_image(pygame.image.load(path.join(img_dir, 'spacebar.png')), (150, 50))
 
     DISPLAYSURF.blit(background, background_rect)
     DISPLAYSURF.blit(title, (0,20))
@@ -485,7 +1540,7 @@ def menu():
     draw_text(DISPLAYSURF, "MOVE:", 35, 100, 436, DARKGREY)
     draw_text(DISPLAYSURF, "SHOOT:", 35, 101, 516, DARKGREY)
 
-    pygame.display.update()
+    present()
 
     while True:
         event = pygame.event.poll()
@@ -522,30 +1577,62 @@ def shield_bar(surface, player_shield):
     pygame.draw.rect(surface, GREY, (5, 5, 104, 24), 3)
     pygame.draw.rect(surface, player_shield_color, (7, 7, player_shield, 20))
 
-def main(): 
-    '''main loop'''
-    #### load all game images ####
+def prepare_image(image, size=None, transparency='alpha', rle=True):
+    '''scale an image once and convert it to the fastest blit format for its transparency'''
+    if size:
+        image = pygame.transform.scale(image, size)
+    if transparency == 'alpha':
+        image = image.convert_alpha()
+        if rle:
+            image.set_alpha(255, pygame.RLEACCEL)
+    elif transparency == 'colorkey':
+        image = image.convert()
+        image.set_colorkey(BLACK, pygame.RLEACCEL if rle else 0)
+    else:
+        image = image.convert()
+    verify_image(image, transparency, rle)
+    return image
+
+def verify_image(image, transparency, rle=True):
+    '''raise ValueError if an image is not in display format for its transparency'''
+    flags = image.get_flags()
+    if transparency == 'alpha':
+        prepared = flags & pygame.SRCALPHA and image.get_bitsize() == 32
+    else:
+        prepared = (not flags & pygame.SRCALPHA
+                    and image.get_bitsize() == pygame.display.get_surface().get_bitsize())
+        if transparency == 'colorkey':
+            prepared = prepared and image.get_colorkey() is not None
+    if rle and transparency != 'opaque':
+        prepared = prepared and flags & pygame.RLEACCELOK
+    if not prepared:
+        raise ValueError('image is not prepared for {} blits'.format(transparency))
+
+def load_images(accelerate=True):
+    '''load, scale and convert all game images'''
+    # images that are rotated are not run-length encoded, since
+    # rotating has to decode them every time
+    def load(filename):
+        return pygame.image.load(path.join(img_dir, filename))
+
     # draw background rectangle first
-    background = pygame.image.load('images/stars_bg.jpeg').convert()
+    background = prepare_image(load('stars_bg.jpeg'), transparency='opaque')
     background_rect = background.get_rect()
-    planet = pygame.image.load('images/planet.png').convert()
-    planet = pygame.transform.scale(planet, (400, 400))
-    planet.set_colorkey(BLACK)
+    planet = prepare_image(load('planet.png'), (400, 400), 'colorkey', accelerate)
     planet_rect = planet.get_rect(center=(70,70))
 
-    black_bar = pygame.Surface((WINDOWWIDTH, 35))
+    black_bar = prepare_image(pygame.Surface((WINDOWWIDTH, 35)), transparency='opaque')
     
     # load player and bullet images
-    player_img = pygame.image.load('images/spaceship.png').convert()
-    life_player_image = pygame.transform.scale(player_img, (25, 25))
-    life_player_image.set_colorkey(BLACK)
-    bullet_img = pygame.image.load('images/laser_red.png').convert()
-    enemy_bullet_img = pygame.image.load('images/laser_purple.png').convert()
-    missile_img = pygame.image.load('images/missile.png').convert_alpha()
-    energy_shield = pygame.image.load('images/energy_shield.png').convert_alpha()
+    player_img = prepare_image(load('spaceship.png'), (70, 70), 'colorkey', accelerate)
+    life_player_image = prepare_image(load('spaceship.png'), (25, 25), 'colorkey', accelerate)
+    bullet_img = prepare_image(load('laser_red.png'), (8, 23), 'colorkey', accelerate)
+    enemy_bullet_img = prepare_image(load('laser_purple.png'), (8, 23), 'colorkey', accelerate)
+    missile_img = prepare_image(load('missile.png'), (25, 38), rle=False)
+    energy_shield = prepare_image(load('energy_shield.png'), (85, 85), rle=accelerate)
 
     # load enemy images
-    enemy_img = pygame.image.load('images/spacecraft_enemy.png').convert_alpha()
+    enemy_img = prepare_image(load('spacecraft_enemy.png'), (60, 60), rle=accelerate)
 
     # load asteroid images and put asteroid names in a list
     asteroid_images = []
@@ -558,7 +1645,17 @@ def main():
     ]
 
     for image in asteroid_list:
-        asteroid_images.append(pygame.image.load(path.join(img_dir, image)).convert_alpha())
+        asteroid_images.append(prepare_image(load(image), rle=False))
+
+    # indices of the fragment images for each asteroid image
+    asteroid_fragments = []
+    for i, image in enumerate(asteroid_list):
+        fragments = [asteroid_list.index(name) for name in ASTEROID_FRAGMENTS[image]]
+        for fragment in fragments:
+            if (asteroid_images[fragment].get_width() >= asteroid_images[i].get_width()
+                    or asteroid_images[fragment].get_height() >= asteroid_images[i].get_height()):
+                raise ValueError('{} is not smaller than {}'.format(asteroid_list[fragment], image))
+        asteroid_fragments.append(fragments)
 
     # asteroid explosion
     explosion_anim = {}
@@ -567,19 +1664,17 @@ def main():
     explosion_anim['ship'] = []
     for i in range(5):
         filename = 'explosion0{}.png'.format(i)
-        img = pygame.image.load(path.join(img_dir, filename)).convert_alpha()
+        img = load(filename)
         # change the sizes of the explosion
-        image_lg = pygame.transform.scale(img, (75, 75))
+        image_lg = prepare_image(img, (75, 75), rle=accelerate)
         explosion_anim['large'].append(image_lg)
-        image_sm = pygame.transform.scale(img, (45, 45))
+        image_sm = prepare_image(img, (45, 45), rle=accelerate)
         explosion_anim['small'].append(image_sm)
     
     for i in range(10):
         filename = 'ship_explosion0{}.png'.format(i)
-        img = pygame.image.load(path.join(img_dir, filename)).convert()
-        img.set_colorkey(BLACK)
         # change the sizes of the explosion
-        image_player = pygame.transform.scale(img, (100, 100))
+        image_player = prepare_image(load(filename), (100, 100), 'colorkey', accelerate)
         explosion_anim['ship'].append(image_player)
 
     # boost animation
@@ -587,17 +1682,106 @@ def main():
     boost_anim['boost'] = []
     for i in range(8):
         filename = 'boost0{}.png'.format(i)
-        img = pygame.image.load(path.join(img_dir, filename)).convert_alpha()
         # change the sizes of the explosion
-        boost_img = pygame.transform.scale(img, (50,50))
+        boost_img = prepare_image(load(filename), (50,50), rle=accelerate)
         boost_anim['boost'].append(boost_img)
 
     # load powerup images
     powerup_images = {}
-    powerup_images['shield'] = pygame.image.load(path.join(img_dir, 'shield.png')).convert_alpha()
-    powerup_images['shield'] = pygame.transform.scale(powerup_images['shield'], (35, 35)) 
-    powerup_images['missile'] = pygame.image.load(path.join(img_dir, 'missile_powerup.png')).convert_alpha()
-    powerup_images['missile'] = pygame.transform.scale(powerup_images['missile'], (45, 45)) 
+    powerup_images['shield'] = prepare_image(load('shield.png'), (35, 35), rle=accelerate)
+    powerup_images['missile'] = prepare_image(load('missile_powerup.png'), (45, 45), rle=accelerate)
+
+    images = {
+        'background': background,
+        'background_rect': background_rect,
+        'planet': planet,
+        'planet_rect': planet_rect,
+        'black_bar': black_bar,
+        'player_img': player_img,
+        'life_player_image': life_player_image,
+        'bullet_img': bullet_img,
+        'enemy_bullet_img': enemy_bullet_img,
+        'missile_img': missile_img,
+        'energy_shield': energy_shield,
+        'enemy_img': enemy_img,
+        'asteroid_images': asteroid_images,
+        'asteroid_fragments': asteroid_fragments,
+        'explosion_anim': explosion_anim,
+        'boost_anim': boost_anim,
+        'powerup_images': powerup_images
+    }
+    return images
+
+def benchmark_blits(frames=200):
+    '''time drawing a typical frame of sprites with unaccelerated and prepared images'''
+    results = {}
+    for accelerate in (False, True):
+        images = load_images(accelerate)
+        random.seed(0) # build the same scene both times
+        sprites = pygame.sprite.Group()
+        bullets = pygame.sprite.Group()
+        player = Player(images['player_img'], images['bullet_img'], images['missile_img'], sprites,
+                        bullets, None, None, TargetGrid())
+        sprites.add(player, Shield(images['energy_shield'], player.rect.center, player))
+        for i in range(3):
+            enemy_ship = EnemyShip(images['enemy_img'], images['enemy_bullet_img'], sprites,
+                                   pygame.sprite.Group(), None, images['boost_anim'])
+            enemy_ship.rect.bottom = 130
+            sprites.add(enemy_ship)
+        for i in range(10):
+            asteroid = Asteroid(images['asteroid_images'], sprites, None)
+            asteroid.rect.y = random.randrange(40, WINDOWHEIGHT - 100)
+            sprites.add(asteroid)
+        for i in range(12):
+            x, y = random.randrange(WINDOWWIDTH), random.randrange(40, WINDOWHEIGHT)
+            sprites.add(Bullet(images['bullet_img'], x, y), EnemyBullet(images['enemy_bullet_img'], x, y))
+        for i in range(4):
+            sprites.add(Missile(images['missile_img'], random.randrange(WINDOWWIDTH), WINDOWHEIGHT - 100))
+        for i, ex_type in enumerate(EXPLOSION_TYPES * 2):
+            explosion = Explosion((80 * i + 40, 300), ex_type, images['explosion_anim'])
+            sprites.add(explosion)
+        for i in range(6):
+            sprites.add(Boost((80 * i + 40, 150), 'boost', images['boost_anim']))
+        for center in ((120, 250), (360, 250)):
+            sprites.add(PowerUp(center, images['powerup_images']))
+
+        sprites.draw(DISPLAYSURF) # run-length encoding happens on the first blit
+        # keep the best of a few runs to filter out noise
+        best = None
+        for run in range(5):
+            start = perf_counter()
+            for i in range(frames):
+                sprites.draw(DISPLAYSURF)
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[accelerate] = best * 1000 / frames
+
+    print("all_active_sprites.draw, {} frames of {} sprites:".format(frames, len(sprites)))
+    print("  unaccelerated: {:.3f} ms per frame".format(results[False]))
+    print("  prepared:      {:.3f} ms per frame ({:.1f}x speedup)".format(
+        results[True], results[False] / results[True]))
+
+def main(): 
+    '''main loop'''
+    #### load all game images ####
+    images = load_images()
+    background = images['background']
+    background_rect = images['background_rect']
+    planet = images['planet']
+    planet_rect = images['planet_rect']
+    black_bar = images['black_bar']
+    player_img = images['player_img']
+    life_player_image = images['life_player_image']
+    bullet_img = images['bullet_img']
+    enemy_bullet_img = images['enemy_bullet_img']
+    missile_img = images['missile_img']
+    energy_shield = images['energy_shield']
+    enemy_img = images['enemy_img']
+    asteroid_images = images['asteroid_images']
+    asteroid_fragments = images['asteroid_fragments']
+    explosion_anim = images['explosion_anim']
+    boost_anim = images['boost_anim']
+    powerup_images = images['powerup_images']
 
     # load game sounds
     bullet_sound = pygame.mixer.Sound(path.join(sound_dir, 'laser.wav'))
@@ -610,8 +1794,24 @@ def main():
     ship_expl = pygame.mixer.Sound(path.join(sound_dir, 'explosion_ship.wav'))
     ship_expl.set_volume(0.4)
 
+    # everything needed to rebuild sprites from a snapshot
+    assets = {
+        'asteroid_images': asteroid_images,
+        'enemy_img': enemy_img,
+        'enemy_bullet_img': enemy_bullet_img,
+        'enemy_bullet_sound': enemy_bullet_sound,
+        'boost_anim': boost_anim,
+        'powerup_images': powerup_images
+    }
+
+    # host a co-op game for a client started with --join
+    server = NetServer(options.port) if options.host else None
+    frame_count = 0
+
     running = True
     show_menu = True
+    recorder = None
+    expl_ship = None # the last ship explosion, the game ends once it finishes
     while running: # main game loop
         if show_menu:
             menu()
@@ -637,11 +1837,36 @@ def main():
             powerups = pygame.sprite.Group()
             # create group for enemies
             enemy_ships = pygame.sprite.Group()
-
+            groups = {
+                'all_sprites': all_active_sprites,
+                'bullets': bullets,
+                'enemy_bullets': enemy_bullets,
+                'asteroids': asteroids,
+                'powerups': powerups,
+                'enemy_ships': enemy_ships
+            }
+            # recent snapshots for rewinding
+            history = SnapshotRing(HISTORY_SIZE)
+
+            # nearest-target lookups for homing missiles
+            targets = TargetGrid()
+            # asteroid debris
+            particles = ParticleSystem()
+            # in co-op the players start side by side
+            start_x = WINDOWWIDTH / 3 if server else WINDOWWIDTH / 2
             player = Player(player_img, bullet_img, missile_img, all_active_sprites, 
-                            bullets, bullet_sound, missile_sound)
+                            bullets, bullet_sound, missile_sound, targets, start_x=start_x)
             shield = Shield(energy_shield, player.rect.center, player)
             all_active_sprites.add(player, shield)
+            players = [player]
+
+            # the second player is flown with the keys sent by the client
+            if server:
+                partner = Player(player_img, bullet_img, missile_img, all_active_sprites, bullets,
+                                 bullet_sound, missile_sound, targets, server.controls, 1, WINDOWWIDTH * 2 / 3)
+                partner_shield = Shield(energy_shield, partner.rect.center, partner)
+                all_active_sprites.add(partner, partner_shield)
+                players.append(partner)
 
             for i in range(2):
                 enemy_ship = EnemyShip(enemy_img, enemy_bullet_img, all_active_sprites, 
@@ -661,127 +1886,187 @@ def main():
         for event in pygame.event.get():
             if event.type == QUIT:
                 running = False
+                if recorder:
+                    recorder.stop(wait=True)
+                if server:
+                    server.close()
                 pygame.quit()
                 sys.exit()
-
-        # update all sprites
-        all_active_sprites.update()
-
-        #### Collision Checking ####
-        # check if a bullet hit an asteroid
-        asteroid_hit = pygame.sprite.groupcollide(asteroids, bullets, True, pygame.sprite.collide_circle)
-        # when asteroids are destroyed, spawn new asteroids
-        for hit in asteroid_hit:
-            score += 50 - hit.radius # different scores for different size asteroids
-            large_expl.play()
-            large_expl.set_volume(0.1)
-            expl = Explosion(hit.rect.center, 'large', explosion_anim)
-            all_active_sprites.add(expl)
-            if random.random() > 0.92:
-                powerup = PowerUp(hit.rect.center, powerup_images)
-                all_active_sprites.add(powerup)
-                powerups.add(powerup)
-            new_asteroid = Asteroid(asteroid_images, all_active_sprites, asteroids)
-            all_active_sprites.add(new_asteroid)
-            asteroids.add(new_asteroid)
-
-        # check if a bullet hit an enemy ship
-        enemy_hit = pygame.sprite.groupcollide(enemy_ships, bullets, True, pygame.sprite.collide_circle)
-        # when asteroids are destroyed, spawn new asteroids
-        for hit in enemy_hit:
-            score += 75
-            ship_expl.play()
-            ship_expl.set_volume(0.1)
-            expl = Explosion(hit.rect.center, 'ship', explosion_anim)
-            all_active_sprites.add(expl)
-            if random.random() > 0.85:
-                powerup = PowerUp(hit.rect.center, powerup_images)
-                all_active_sprites.add(powerup)
-                powerups.add(powerup)
-            new_ship = EnemyShip(enemy_img, enemy_bullet_img, all_active_sprites, enemy_bullets, 
-                                 enemy_bullet_sound, boost_anim)
-            all_active_sprites.add(new_ship)
-            enemy_ships.add(new_ship)
-            
-        # check if enemy bullet hit player
-        player_hit_by_bullet = pygame.sprite.spritecollide(player, enemy_bullets, True)
-
-        # if player is hit
-        for hit in player_hit_by_bullet:
-            #print("Player hit")
-            player.shield -= 5
-            if player.shield <= 0:
+            elif event.type == pygame.KEYDOWN:
+                # quick save and quick load
+                if event.key == pygame.K_F5 and len(history) > 0:
+                    save_snapshot(SAVE_FILE, history.latest())
+                elif event.key == pygame.K_F9 and not server and path.exists(SAVE_FILE):
+                    try:
+                        score = restore_world(load_snapshot(SAVE_FILE), player, groups, assets)
+                        history.clear()
+                    except (ValueError, OSError) as error:
+                        print("Could not load save:", error)
+                # start or stop recording gameplay
+                elif event.key == pygame.K_F12:
+                    if recorder:
+                        recorder.stop()
+                        recorder = None
+                        pygame.display.set_caption('The Lonely Shooter')
+                    else:
+                        capture_dir = path.join(CAPTURE_DIR, datetime.now().strftime('%Y%m%d-%H%M%S'))
+                        recorder = FrameRecorder(DISPLAYSURF.get_size(), capture_dir)
+                        pygame.display.set_caption('The Lonely Shooter [REC]')
+
+        # read the co-op client's keys before moving its ship
+        if server:
+            server.receive()
+
+        # hold 'r' to rewind through recent snapshots
+        if pygame.key.get_pressed()[pygame.K_r] and len(history) > 0:
+            score = restore_world(history.pop(), player, groups, assets)
+            particles.clear()
+        else:
+            # update all sprites
+            targets.rebuild(asteroids, enemy_ships)
+            all_active_sprites.update()
+            particles.update()
+
+            #### Collision Checking ####
+            # check if a bullet hit an asteroid
+            asteroid_hit = pygame.sprite.groupcollide(asteroids, bullets, True, pygame.sprite.collide_circle)
+            # when asteroids are destroyed, spawn new asteroids
+            for hit in asteroid_hit:
+                score += 50 - hit.radius # different scores for different size asteroids
+                large_expl.play()
+                large_expl.set_volume(0.1)
+                expl = Explosion(hit.rect.center, 'large', explosion_anim)
+                all_active_sprites.add(expl)
+                particles.emit(hit.rect.center, DEBRIS_PER_ASTEROID)
+                if random.random() > 0.92:
+                    powerup = PowerUp(hit.rect.center, powerup_images)
+                    all_active_sprites.add(powerup)
+                    powerups.add(powerup)
+                # split larger asteroids into smaller fragments
+                fragment_images = asteroid_fragments[hit.image_index]
+                if len(asteroids) + len(fragment_images) <= MAX_ASTEROIDS:
+                    for i, image_index in enumerate(fragment_images):
+                        side = 1 if i % 2 else -1
+                        fragment = Asteroid(asteroid_images, all_active_sprites, asteroids, image_index,
+                                            (hit.rect.centerx + side * 15, hit.rect.centery), True)
+                        fragment.speedx = side * random.randrange(2, 5)
+                        fragment.speedy = hit.speedy + random.randrange(-2, 3)
+                        all_active_sprites.add(fragment)
+                        asteroids.add(fragment)
+                # only asteroids from the original wave are replaced
+                if not hit.fragment:
+                    new_asteroid = Asteroid(asteroid_images, all_active_sprites, asteroids)
+                    all_active_sprites.add(new_asteroid)
+                    asteroids.add(new_asteroid)
+
+            # check if a bullet hit an enemy ship
+            enemy_hit = pygame.sprite.groupcollide(enemy_ships, bullets, True, pygame.sprite.collide_circle)
+            # when asteroids are destroyed, spawn new asteroids
+            for hit in enemy_hit:
+                score += 75
                 ship_expl.play()
-                expl_ship = Explosion(player.rect.center, 'ship', explosion_anim)
-                all_active_sprites.add(expl_ship)
-                player.hide()
-                player.lives -= 1
-                player.shield = 100
-
-        # check for collisions between asteroids and player
-        player_hit = pygame.sprite.spritecollide(player, asteroids, True)
-
-        # if player is hit
-        for hit in player_hit:
-            player.shield -= random.randint(10, 25)
-            #print(player.shield)
-            small_expl.play()
-            small_expl.set_volume(0.1)
-            expl = Explosion(hit.rect.center, 'small', explosion_anim)
-            all_active_sprites.add(expl)
-            new_asteroid = Asteroid(asteroid_images, all_active_sprites, asteroids)
-            all_active_sprites.add(new_asteroid)
-            asteroids.add(new_asteroid)
-            if player.shield <= 0:
-                ship_expl.play()
-                expl_ship = Explosion(player.rect.center, 'ship', explosion_anim)
-                all_active_sprites.add(expl_ship)
-                player.hide()
-                player.lives -= 1
-                player.shield = 100
-
-        # check for collisions between enemy ships and player
-        player_hit_by_ship = pygame.sprite.spritecollide(player, enemy_ships, True)
-
-        # if player is hit by enemy ship
-        for hit in player_hit_by_ship:
-            player.shield -= 35
-            ship_expl.play()
-            ship_expl.set_volume(0.1)
-            expl = Explosion(hit.rect.center, 'ship', explosion_anim)
-            all_active_sprites.add(expl)
-            new_ship = EnemyShip(enemy_img, enemy_bullet_img, all_active_sprites, enemy_bullets, 
-                                 enemy_bullet_sound, boost_anim)
-            all_active_sprites.add(new_ship)
-            enemy_ships.add(new_ship)
-            if player.shield <= 0:
-                ship_expl.play()
-                expl_ship = Explosion(player.rect.center, 'ship', explosion_anim)
-                all_active_sprites.add(expl_ship)
-                player.hide()
-                player.lives -= 1
-                player.shield = 100
-        
-        # check for collisions between player and power ups
-        powerup_hit = pygame.sprite.spritecollide(player, powerups, True)
+                ship_expl.set_volume(0.1)
+                expl = Explosion(hit.rect.center, 'ship', explosion_anim)
+                all_active_sprites.add(expl)
+                if random.random() > 0.85:
+                    powerup = PowerUp(hit.rect.center, powerup_images)
+                    all_active_sprites.add(powerup)
+                    powerups.add(powerup)
+                new_ship = EnemyShip(enemy_img, enemy_bullet_img, all_active_sprites, enemy_bullets, 
+                                     enemy_bullet_sound, boost_anim)
+                all_active_sprites.add(new_ship)
+                enemy_ships.add(new_ship)
+            
+            # check collisions for each player
+            for pilot in players:
+                # check if enemy bullet hit player
+                player_hit_by_bullet = pygame.sprite.spritecollide(pilot, enemy_bullets, True)
+
+                # if player is hit
+                for hit in player_hit_by_bullet:
+                    #print("Player hit")
+                    pilot.shield -= 5
+                    if pilot.shield <= 0:
+                        ship_expl.play()
+                        expl_ship = Explosion(pilot.rect.center, 'ship', explosion_anim)
+                        all_active_sprites.add(expl_ship)
+                        pilot.hide()
+                        pilot.lives -= 1
+                        pilot.shield = 100
+
+                # check for collisions between asteroids and player
+                player_hit = pygame.sprite.spritecollide(pilot, asteroids, True)
+
+                # if player is hit
+                for hit in player_hit:
+                    pilot.shield -= random.randint(10, 25)
+                    #print(player.shield)
+                    small_expl.play()
+                    small_expl.set_volume(0.1)
+                    expl = Explosion(hit.rect.center, 'small', explosion_anim)
+                    all_active_sprites.add(expl)
+                    if not hit.fragment:
+                        new_asteroid = Asteroid(asteroid_images, all_active_sprites, asteroids)
+                        all_active_sprites.add(new_asteroid)
+                        asteroids.add(new_asteroid)
+                    if pilot.shield <= 0:
+                        ship_expl.play()
+                        expl_ship = Explosion(pilot.rect.center, 'ship', explosion_anim)
+                        all_active_sprites.add(expl_ship)
+                        pilot.hide()
+                        pilot.lives -= 1
+                        pilot.shield = 100
+
+                # check for collisions between enemy ships and player
+                player_hit_by_ship = pygame.sprite.spritecollide(pilot, enemy_ships, True)
+
+                # if player is hit by enemy ship
+                for hit in player_hit_by_ship:
+                    pilot.shield -= 35
+                    ship_expl.play()
+                    ship_expl.set_volume(0.1)
+                    expl = Explosion(hit.rect.center, 'ship', explosion_anim)
+                    all_active_sprites.add(expl)
+                    new_ship = EnemyShip(enemy_img, enemy_bullet_img, all_active_sprites, enemy_bullets, 
+                                         enemy_bullet_sound, boost_anim)
+                    all_active_sprites.add(new_ship)
+                    enemy_ships.add(new_ship)
+                    if pilot.shield <= 0:
+                        ship_expl.play()
+                        expl_ship = Explosion(pilot.rect.center, 'ship', explosion_anim)
+                        all_active_sprites.add(expl_ship)
+                        pilot.hide()
+                        pilot.lives -= 1
+                        pilot.shield = 100
         
-        # check if player hits power up
-        for hit in powerup_hit:
-            if hit.type == 'shield':
-                score += 100
-                player.shield += 20
-                if player.shield >= 100:
-                    player.shield = 100
-            if hit.type == 'missile':
-                score += 50
-                player.upgrade_power()
+                # check for collisions between player and power ups
+                powerup_hit = pygame.sprite.spritecollide(pilot, powerups, True)
         
+                # check if player hits power up
+                for hit in powerup_hit:
+                    if hit.type == 'shield':
+                        score += 100
+                        pilot.shield += 20
+                        if pilot.shield >= 100:
+                            pilot.shield = 100
+                    if hit.type == 'missile':
+                        score += 50
+                        pilot.upgrade_power()
+
+            # record this tick for rewinding, single player only
+            if player.lives > 0 and not server:
+                history.append(capture_world(score, player, groups))
+
         # If player dies, return to menu
-        if player.lives == 0 and not expl_ship.alive():
+        if all(pilot.lives == 0 for pilot in players) and not (expl_ship and expl_ship.alive()):
             #print("in loop")
             #running = False
             pygame.mixer.music.stop()
             show_menu = True
+            if recorder:
+                recorder.stop()
+                recorder = None
+                pygame.display.set_caption('The Lonely Shooter')
             
         # draw/render 
         DISPLAYSURF.fill(BLACK)
@@ -790,6 +2075,7 @@ def main():
         DISPLAYSURF.blit(planet, planet_rect)
 
         all_active_sprites.draw(DISPLAYSURF)
+        particles.draw(DISPLAYSURF)
         DISPLAYSURF.blit(black_bar, (0,0))
         pygame.draw.rect(DISPLAYSURF, GREY, (0, 0, WINDOWWIDTH, 35), 3)
         shield_bar(DISPLAYSURF, player.shield)
@@ -801,9 +2087,71 @@ def main():
         # display lives
         draw_lives(DISPLAYSURF, WINDOWWIDTH - 100, 5, player.lives, life_player_image)
 
+        # send the co-op client a snapshot at NET_SNAPSHOT_RATE
+        if server:
+            frame_count += 1
+            if frame_count % (FPS // NET_SNAPSHOT_RATE) == 0:
+                server.send_snapshot(score, players, all_active_sprites)
+            server.stats.update()
+            draw_text(DISPLAYSURF, server.stats.text(), 14, WINDOWWIDTH / 2, WINDOWHEIGHT - 20, WHITE)
+
+        # copy the finished frame for the encoder
+        if recorder:
+            recorder.capture(DISPLAYSURF)
+
         # done after drawing everything to the screen
         FPSCLOCK.tick(FPS) # number of FPS per loop
-        pygame.display.flip()
+        particles.adjust_budget(FPSCLOCK.get_rawtime())
+        present()
+
+def run_client(host, port=NET_PORT):
+    '''join a co-op game and draw the snapshots sent by the host'''
+    images = load_images()
+    sprite_images = NetSpriteImages(images)
+    client = NetClient(host, port, sprite_images.valid)
+
+    while True:
+        for event in pygame.event.get():
+            if event.type == QUIT:
+                client.close()
+                pygame.quit()
+                sys.exit()
+
+        client.send_input(pygame.key.get_pressed())
+        client.receive()
+        client.stats.update()
+        entities, hud = client.state()
+
+        # draw/render
+        DISPLAYSURF.fill(BLACK)
+        DISPLAYSURF.blit(images['background'], images['background_rect'])
+        DISPLAYSURF.blit(images['planet'], images['planet_rect'])
+
+        if entities is None:
+            draw_text(DISPLAYSURF, "WAITING FOR HOST", 35, WINDOWWIDTH / 2, WINDOWHEIGHT / 2, WHITE)
+        else:
+            for kind, variant, x, y, frame in entities:
+                image = sprite_images.get(kind, variant, frame)
+                DISPLAYSURF.blit(image, image.get_rect(center=(round(x), round(y))))
+
+            # the client flies the second ship
+            score, host_shield, host_lives, guest_shield, guest_lives = hud
+            DISPLAYSURF.blit(images['black_bar'], (0,0))
+            pygame.draw.rect(DISPLAYSURF, GREY, (0, 0, WINDOWWIDTH, 35), 3)
+            shield_bar(DISPLAYSURF, guest_shield)
+            draw_text(DISPLAYSURF, "SCORE", 12, WINDOWWIDTH / 2, 2, WHITE)
+            draw_text(DISPLAYSURF, str(score), 25, WINDOWWIDTH / 2, 12, WHITE)
+            draw_lives(DISPLAYSURF, WINDOWWIDTH - 100, 5, guest_lives, images['life_player_image'])
+
+        draw_text(DISPLAYSURF, client.stats.text(), 14, WINDOWWIDTH / 2, WINDOWHEIGHT - 20, WHITE)
+
+        FPSCLOCK.tick(FPS)
+        present()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if options.bench_blit:
+        benchmark_blits()
+    elif options.join:
+        run_client(options.join, options.port)
+    else:
+        main()
\ No newline at end of file